@@ -1,12 +1,26 @@
 # Created by Noah Kantrowitz on 2007-07-04.
 # Copyright (c) 2007 Noah Kantrowitz. All rights reserved.
 
+import atexit
+import threading
+import time
+from collections import OrderedDict, deque
+
+from trac.admin.api import AdminCommandError, IAdminCommandProvider
+from trac.config import BoolOption, FloatOption, IntOption
 from trac.core import *
 from trac.env import IEnvironmentSetupParticipant
-from trac.db import DatabaseManager
+from trac.db import Column, DatabaseManager, Index, Table
+from trac.ticket.model import Ticket
 from trac.util.compat import set, sorted
+from trac.util.text import exception_to_unicode, print_table, printout
+from trac.web.api import IRequestFilter
+from trac.web.chrome import ITemplateStreamFilter
 
 import db_default
+from attachmentflags import profile
+from attachmentflags.model import count_live_patches, count_stale_patch_fields, \
+                                  rebuild_summary, select_stale_patch_fields
 
 class AttachmentFlagsSystem(Component):
     """Central functionality for the AttachmentFlags plugin."""
@@ -16,7 +30,8 @@ class AttachmentFlagsSystem(Component):
     # IEnvironmentSetupParticipant methods
     def environment_created(self):
         self.found_db_version = 0
-        self.upgrade_environment(self.env.get_db_cnx())
+        with self.env.db_transaction as db:
+            self.upgrade_environment(db)
         
     def environment_needs_upgrade(self, db):
         cursor = db.cursor()
@@ -35,38 +50,489 @@ class AttachmentFlagsSystem(Component):
         return False
             
     def upgrade_environment(self, db):
-        # Upgrade to revision 1
         db_manager, _ = DatabaseManager(self.env)._get_connector()
-                
-        # Insert the default table
-        old_data = {} # {table_name: (col_names, [row, ...]), ...}
         cursor = db.cursor()
         if not self.found_db_version:
             cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)",(db_default.name, db_default.version))
         else:
             cursor.execute("UPDATE system SET value=%s WHERE name=%s",(db_default.version, db_default.name))
-            for tbl in db_default.tables:
-                try:
-                    cursor.execute('SELECT * FROM %s'%tbl.name)
-                    old_data[tbl.name] = ([d[0] for d in cursor.description], cursor.fetchall())
-                    cursor.execute('DROP TABLE %s'%tbl.name)
-                except Exception, e:
-                    if 'OperationalError' not in e.__class__.__name__:
-                        raise e # If it is an OperationalError, just move on to the next table
-                            
-                
+
+        table_names = db.get_table_names()
+        created = set()
+
+        # Upgrade to revision 4: one row per attachment with a flag bitmask
+        if 'attachmentflags' in table_names and \
+                'flag' in db.get_column_names('attachmentflags'):
+            self._convert_to_bitmask(db, db_manager)
+            created.add('attachmentflags')
+        # Upgrade to revision 5: count the changes of each row
+        elif 'attachmentflags' in table_names and \
+                'changes' not in db.get_column_names('attachmentflags'):
+            cursor.execute("ALTER TABLE attachmentflags ADD COLUMN changes integer")
+            cursor.execute("UPDATE attachmentflags SET changes=1")
+
+        # Revision 2 added indexes to the old table. Tables older than
+        # revision 4 are converted above, with the indexes of db_default.
+        for tbl in db_default.tables:
+            if tbl.name not in created and tbl.name not in table_names:
+                for sql in db_manager.to_sql(tbl):
+                    cursor.execute(sql)
+
+        # Upgrade to revision 3: fill the summary table
+        if 0 < self.found_db_version < 3:
+            rebuild_summary(self.env)
+
+    # Internal
+    convert_batch_size = 1000
+
+    def _convert_to_bitmask(self, db, db_manager):
+        """Convert the attachmentflags table from one row per flag to one row
+        per attachment, with the flags in a bitmask. The conversion runs on
+        the database server, through a staging table, for the flags of
+        `convert_batch_size` resources at a time."""
+        cursor = db.cursor()
+        staging = Table('attachmentflags_old')[
+            Column('type'),
+            Column('id'),
+            Column('filename'),
+            Column('flag'),
+            Column('value'),
+            Column('updated_on', type="int"),
+            Column('updated_by'),
+            Index(['id']),
+        ]
+        columns = ','.join(c.name for c in staging.columns)
+        for sql in db_manager.to_sql(staging):
+            cursor.execute(sql)
+        cursor.execute("INSERT INTO %s (%s) SELECT %s FROM attachmentflags" %
+                       (staging.name, columns, columns))
+        cursor.execute("DROP TABLE attachmentflags")
         for tbl in db_default.tables:
-            for sql in db_manager.to_sql(tbl):
-                cursor.execute(sql)
-                    
-            # Try to reinsert any old data
-            if tbl.name in old_data:
-                data = old_data[tbl.name]
-                sql = 'INSERT INTO %s (%s) VALUES (%s)' % \
-                      (tbl.name, ','.join(data[0]), ','.join(['%s'] * len(data[0])))
-                for row in data[1]:
-                    try:
-                        cursor.execute(sql, row)
-                    except Exception, e:
-                        if 'OperationalError' not in e.__class__.__name__:
-                            raise e
+            if tbl.name == 'attachmentflags':
+                for sql in db_manager.to_sql(tbl):
+                    cursor.execute(sql)
+
+        names = ['flags', 'updated_on', 'changes']
+        values = [' + '.join("MAX(CASE WHEN flag='%s' THEN %d ELSE 0 END)" % (flag, bit)
+                             for flag, bit in db_default.flag_bits),
+                  'MAX(updated_on)', '1']
+        for flag, bit in db_default.flag_bits:
+            names += [flag + '_on', flag + '_by']
+            values += ["MAX(CASE WHEN flag='%s' THEN updated_on END)" % flag,
+                       "MAX(CASE WHEN flag='%s' THEN updated_by END)" % flag]
+        insert = "INSERT INTO attachmentflags (type,id,filename,%s) " \
+                 "SELECT type,id,filename,%s FROM %s WHERE flag IN (%s) " \
+                 "AND id > %%s AND id <= %%s GROUP BY type,id,filename" % \
+                 (','.join(names), ','.join(values), staging.name,
+                  ','.join("'%s'" % flag for flag, bit in db_default.flag_bits))
+
+        cursor.execute("SELECT COUNT(*) FROM %s" % staging.name)
+        total = cursor.fetchone()[0]
+        last = ''
+        converted = 0
+        while True:
+            # Continue after the last resource that was converted
+            cursor.execute("SELECT DISTINCT id FROM %s WHERE id > %%s ORDER BY id "
+                           "LIMIT %d" % (staging.name, self.convert_batch_size), (last,))
+            ids = [row[0] for row in cursor]
+            if not ids:
+                break
+            cursor.execute(insert, (last, ids[-1]))
+            cursor.execute("SELECT COUNT(*) FROM %s WHERE id > %%s AND id <= %%s"
+                           % staging.name, (last, ids[-1]))
+            converted += cursor.fetchone()[0]
+            self.log.info("AttachmentFlagsSystem: converted %d of %d flag rows",
+                          converted, total)
+            last = ids[-1]
+        cursor.execute("SELECT COUNT(*) FROM attachmentflags")
+        self.log.info("AttachmentFlagsSystem: converted the flags of %d attachments",
+                      cursor.fetchone()[0])
+        cursor.execute("DROP TABLE %s" % staging.name)
+
+
+class AttachmentFlagsCache(Component):
+    """Process-wide LRU cache of the attachment flags of a resource.
+
+    Entries are keyed by `(realm, id)` of the parent resource. Whenever flags
+    change, the generation counter in the `system` table is incremented, so
+    that other processes drop their cached entries on their next request.
+    Code that runs outside of a request, like `trac-admin` or a background
+    thread, checks the generation on every lookup.
+    """
+
+    implements(IRequestFilter)
+
+    size = IntOption('attachmentflags', 'cache_size', 1000,
+        """Maximum number of resources for which the attachment flags are
+        cached. Set to 0 to disable the cache.""")
+
+    ttl = IntOption('attachmentflags', 'cache_ttl', 300,
+        """Number of seconds after which a cached entry is reloaded from the
+        database.""")
+
+    generation_key = 'attachmentflags_cache_generation'
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._entries = OrderedDict() # {(realm, id): (timestamp, rows)}
+        self._generation = None
+        self._local = threading.local()
+        self.hits = 0
+        self.misses = 0
+
+    # IRequestFilter methods
+    def pre_process_request(self, req, handler):
+        # Check the generation once per request
+        self._local.generation = None
+        self._local.in_request = True
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
+    # Public API
+    @property
+    def enabled(self):
+        return self.size > 0
+
+    def get(self, realm, id, loader):
+        """Return the cached value for the resource, calling `loader` to
+        fetch it from the database when there is no valid entry."""
+        key = (realm, id)
+        generation = self._check_generation()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.time() - entry[0] < self.ttl:
+                self._entries[key] = self._entries.pop(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            if (self.hits + self.misses) % 1000 == 0:
+                self.log.debug("AttachmentFlagsCache: %d hits, %d misses, "
+                               "%d/%d entries", self.hits, self.misses,
+                               len(self._entries), self.size)
+        value = loader()
+        with self._lock:
+            # Do not store data that may have been loaded before an update,
+            # by a request that started before the last known change
+            if generation == self._generation:
+                self._entries.pop(key, None)
+                self._entries[key] = (time.time(), value)
+                while len(self._entries) > self.size:
+                    self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, realm, id):
+        """Drop the entry for the resource, in this and in other processes.
+        Call this after the transaction that changed the flags committed."""
+        self.invalidate_many(realm, [id])
+
+    def invalidate_many(self, realm, ids):
+        """Drop the entries for the resources `ids` at once, like
+        `invalidate()`."""
+        if not ids:
+            return
+        with self.env.db_transaction as db:
+            cursor = profile.cursor(db)
+            cursor.execute("UPDATE system SET value=%s+1 WHERE name=%%s"
+                           % db.cast('value', 'int'), (self.generation_key,))
+            if not cursor.rowcount:
+                cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)",
+                               (self.generation_key, 1))
+            cursor.execute("SELECT value FROM system WHERE name=%s",
+                           (self.generation_key,))
+            generation = int(cursor.fetchone()[0])
+        with self._lock:
+            for id in ids:
+                self._entries.pop((realm, id), None)
+            if self._generation is None or generation > self._generation + 1:
+                # Flags were also changed elsewhere in the meantime
+                self._entries.clear()
+            if self._generation is None or generation > self._generation:
+                self._generation = generation
+        self._local.generation = generation
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self._entries), 'size': self.size}
+
+    # Internal
+    def _check_generation(self):
+        generation = None
+        if getattr(self._local, 'in_request', False):
+            generation = getattr(self._local, 'generation', None)
+        if generation is None:
+            with self.env.db_query as db:
+                cursor = profile.cursor(db)
+                cursor.execute("SELECT value FROM system WHERE name=%s",
+                               (self.generation_key,))
+                row = cursor.fetchone()
+            generation = self._local.generation = int(row[0]) if row else 0
+        with self._lock:
+            # Requests that started before the last change do not reset the
+            # cache; get() just does not store what they load
+            if self._generation is None or generation > self._generation:
+                self._entries.clear()
+                self._generation = generation
+        return generation
+
+
+class AttachmentFlagsProfiler(Component):
+    """Measures the work of the plugin on each request, when `profile` is
+    enabled: the number of queries, the number of `AttachmentFlags` objects,
+    and the time spent in flag updates and in the template filters. Each
+    measurement is written to the log at the debug level, and the recent ones
+    are kept for the statistics admin page.
+
+    The totals of a request are recorded when it redirects, when it has no
+    template, or once its template is rendered. A request that ends otherwise,
+    for instance with `req.send()`, is recorded when the next request on the
+    same thread starts."""
+
+    implements(IRequestFilter, ITemplateStreamFilter)
+
+    enabled = BoolOption('attachmentflags', 'profile', 'false',
+        """Measure the time and the queries that the plugin spends on each
+        request.""")
+
+    samples = IntOption('attachmentflags', 'profile_samples', 1000,
+        """Number of recent measurements that are kept per section for the
+        statistics admin page.""")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {} # {section: deque([(ms, queries, objects), ...])}
+
+    # IRequestFilter methods
+    def pre_process_request(self, req, handler):
+        previous = profile.start(None)
+        if previous is not None:
+            previous.profiler.finish(previous)
+        if self.enabled:
+            stats = profile.RequestStats(self, '%s %s' % (req.method, req.path_info))
+            profile.start(stats)
+            req.add_redirect_listener(lambda req, url, permanent: profile.end(stats))
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        stats = profile.current()
+        if stats is not None and template is None:
+            # Nothing is rendered, after an error for instance
+            profile.end(stats)
+        return template, data, content_type
+
+    # ITemplateStreamFilter methods
+    def filter_stream(self, req, method, filename, stream, data):
+        stats = profile.current()
+        if stats is not None:
+            stream |= profile.end_filter(stats)
+        return stream
+
+    # Public API
+    def add_sample(self, stats, section, ms, queries, objects):
+        """Record a measurement of `section` in the request of `stats`."""
+        self.log.debug("AttachmentFlagsProfiler: section=%s ms=%.3f queries=%d "
+                       "objects=%d path=%s", section, ms, queries, objects, stats.path)
+        with self._lock:
+            samples = self._samples.get(section)
+            if samples is None or samples.maxlen != self.samples:
+                samples = self._samples[section] = deque(samples or (),
+                                                         maxlen=self.samples)
+            samples.append((ms, queries, objects))
+
+    def finish(self, stats):
+        """Record the totals of a request once, if the plugin did anything."""
+        if stats.recorded:
+            return
+        stats.recorded = True
+        if stats.ms or stats.queries or stats.objects:
+            self.add_sample(stats, 'request', stats.ms, stats.queries, stats.objects)
+
+    def stats(self):
+        """Return the percentiles of the recent measurements per section, as
+        a list of dicts ordered by section."""
+        with self._lock:
+            samples = [(section, list(values))
+                       for section, values in self._samples.items()]
+        result = []
+        for section, values in sorted(samples):
+            times = sorted(ms for ms, queries, objects in values)
+            result.append({
+                'section': section,
+                'count': len(values),
+                'p50': _percentile(times, 50),
+                'p90': _percentile(times, 90),
+                'p99': _percentile(times, 99),
+                'max': times[-1],
+                'queries': float(sum(v[1] for v in values)) / len(values),
+                'objects': float(sum(v[2] for v in values)) / len(values),
+            })
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+
+
+def _percentile(values, percent):
+    """Return the `percent` percentile of the sorted `values`."""
+    return values[min(len(values) - 1, len(values) * percent // 100)]
+
+
+class PatchFieldUpdater(Component):
+    """Keeps the patch field of tickets in line with their attachment flags.
+
+    By default the field is updated in the request that changed the flags.
+    When `patch_field_delay` is set, the updates are queued and applied by a
+    background thread instead: repeated updates of the same ticket are merged
+    into one, and tickets whose field already has the right value are not
+    saved."""
+
+    delay = FloatOption('attachmentflags', 'patch_field_delay', 0,
+        """Number of seconds to wait before updating the patch field of a
+        ticket after its attachment flags changed, so that a series of
+        changes results in a single ticket change. Set to 0 to update the
+        field in the request that changed the flags.""")
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = OrderedDict() # {ticket id: author}
+        self._since = None # time of the oldest pending update
+        self._thread = None
+
+    # Public API
+    def update(self, ticket_id, author):
+        """Update the patch field of the ticket, now or after `delay`."""
+        ticket_id = int(ticket_id)
+        if self.delay <= 0:
+            self._apply(ticket_id, author)
+            return
+        with self._cond:
+            self._pending[ticket_id] = author
+            if self._since is None:
+                self._since = time.time()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='AttachmentFlags patch field updater')
+                self._thread.daemon = True
+                self._thread.start()
+                # Do not lose the queued updates when the process exits
+                atexit.register(self.flush)
+            self._cond.notify()
+
+    def flush(self):
+        """Apply all queued updates in the calling thread."""
+        with self._cond:
+            pending = self._take()
+        self._apply_all(pending)
+
+    # Internal
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                wait = self._since + self.delay - time.time()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                pending = self._take()
+            self._apply_all(pending)
+
+    def _take(self):
+        pending = self._pending
+        self._pending = OrderedDict()
+        self._since = None
+        return pending
+
+    def _apply_all(self, pending):
+        saved = 0
+        for ticket_id, author in pending.items():
+            try:
+                if self._apply(ticket_id, author):
+                    saved += 1
+            except Exception, e:
+                self.log.error("Failed to update the patch field of ticket #%s: %s",
+                               ticket_id, exception_to_unicode(e, traceback=True))
+        if pending:
+            self.log.debug("PatchFieldUpdater: saved %d of %d queued tickets",
+                           saved, len(pending))
+
+    def _apply(self, ticket_id, author):
+        value = "1" if count_live_patches(self.env, "ticket", ticket_id) > 0 else "0"
+        ticket = Ticket(self.env, ticket_id)
+        if ticket["patch"] == value:
+            return False
+        ticket["patch"] = value
+        ticket.save_changes(author, None)
+        return True
+
+
+class AttachmentFlagsAdmin(Component):
+    """trac-admin commands for the AttachmentFlags plugin."""
+
+    implements(IAdminCommandProvider)
+
+    # IAdminCommandProvider methods
+    def get_admin_commands(self):
+        yield ('attachmentflags reindex', '[--batch N]',
+               """Recompute the patch state of all tickets
+
+               Rebuilds the summary table from the attachment flags, and then
+               updates the patch field of the tickets where it does not
+               match, N tickets at a time (default: 1000).""",
+               self._complete_reindex, self._do_reindex)
+        yield ('attachmentflags stats', '',
+               'Show statistics about the attachment flags',
+               None, self._do_stats)
+
+    def _complete_reindex(self, args):
+        if len(args) == 1:
+            return ['--batch']
+
+    def _do_reindex(self, *args):
+        batch = 1000
+        if args:
+            if len(args) != 2 or args[0] != '--batch':
+                raise AdminCommandError("Invalid arguments", show_usage=True)
+            try:
+                batch = int(args[1])
+            except ValueError:
+                batch = 0
+            if batch < 1:
+                raise AdminCommandError("The batch size must be a positive number")
+
+        rebuild_summary(self.env)
+        printout("Rebuilt the attachment flags summary")
+
+        last = 0
+        updated = 0
+        while True:
+            rows = select_stale_patch_fields(self.env, last, batch)
+            if not rows:
+                break
+            for id, patches in rows:
+                ticket = Ticket(self.env, id)
+                ticket["patch"] = "1" if patches > 0 else "0"
+                ticket.save_changes('trac-admin', None)
+                last = id
+            updated += len(rows)
+            printout("Updated the patch field of %d tickets" % updated)
+        if not updated:
+            printout("All patch fields are up to date")
+
+    def _do_stats(self):
+        with self.env.db_query as db:
+            cursor = db.cursor()
+            cursor.execute("SELECT %s FROM attachmentflags" %
+                           ','.join("SUM(CASE WHEN (flags & %d) <> 0 THEN 1 ELSE 0 END)" % bit
+                                    for flag, bit in db_default.flag_bits))
+            data = [("Attachments flagged '%s'" % flag, count or 0)
+                    for (flag, bit), count in zip(db_default.flag_bits, cursor.fetchone())]
+            cursor.execute("SELECT COUNT(*) FROM attachmentflags_summary "
+                           "WHERE type='ticket' AND patches>0")
+            data.append(("Tickets with a patch", cursor.fetchone()[0]))
+        data.append(("Tickets with a stale patch field",
+                     count_stale_patch_fields(self.env)))
+        print_table(data, ["Statistic", "Count"])
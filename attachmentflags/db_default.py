@@ -3,18 +3,38 @@
  # All rights reserved. Distributed under the terms of the MIT License.
  #
  
-from trac.db import Table, Column
+from trac.db import Table, Column, Index
 
 name = 'attachmentflags'
-version = 1
+version = 5
+
+# The bit of each flag in the flags column of the attachmentflags table
+flag_bits = [('patch', 1), ('obsolete', 2)]
+
 tables = [
-    Table('attachmentflags', key=('type','id','filename','flag')) [
+    # One row per flagged attachment, with the time and author of the last
+    # change of each flag that is set, and the number of changes of the row
+    Table('attachmentflags', key=('type','id','filename')) [
         Column('type'),
         Column('id'),
         Column('filename'),
-        Column('flag'),
-        Column('value'),
+        Column('flags', type="int"),
+        Column('updated_on', type="int"),
+        Column('changes', type="int"),
+        Column('patch_on', type="int"),
+        Column('patch_by'),
+        Column('obsolete_on', type="int"),
+        Column('obsolete_by'),
+        Index(['updated_on']),
+    ],
+    # Per resource: the number of attachments that are a live patch, the
+    # number of obsolete attachments and the time of the last flag change
+    Table('attachmentflags_summary', key=('type','id')) [
+        Column('type'),
+        Column('id'),
+        Column('patches', type="int"),
+        Column('obsolete', type="int"),
         Column('updated_on', type="int"),
-        Column('updated_by'),
+        Index(['patches']),
     ],
 ]
@@ -4,68 +4,425 @@
  #
 
 import time
+from collections import namedtuple
 
 from trac.attachment import Attachment
+from trac.util.datefmt import to_timestamp
+
+from attachmentflags import profile
+from attachmentflags.db_default import flag_bits
+
+# The columns of the attachmentflags table that are read into memory: the
+# bitmask, followed by the updated_on and updated_by columns of each flag.
+_flag_column_names = ['flags'] + sum([[flag + '_on', flag + '_by']
+                                     for flag, bit in flag_bits], [])
+_flag_columns = ','.join(_flag_column_names)
+_bits = dict(flag_bits)
+_flag_index = dict((flag, i) for i, (flag, bit) in enumerate(flag_bits))
+
+
+class Flag(namedtuple('Flag', 'updated_on updated_by')):
+    """The time and the author of the last change of a flag that is set.
+
+    The fields can also be read by name, like the dicts of earlier versions:
+    `flags['patch']['updated_on']`. Flags are boolean, so their `value` is
+    always `True`."""
+    __slots__ = ()
+
+    value = True
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            if key not in self._fields and key != 'value':
+                raise KeyError(key)
+            return getattr(self, key)
+        return tuple.__getitem__(self, key)
 
 class AttachmentFlags(object):
-    def __init__(self, env, attachment):
+    """The flags of an attachment. They are read from the database on first
+    use, and kept as the fetched row of `_flag_columns`."""
+
+    __slots__ = ('env', 'attachment', '__row', '__updatedflags')
+
+    def __init__(self, env, attachment, row=False):
+        """Create the flags of `attachment`. When `row` is given, it should
+        be the `_flag_columns` of the attachment that were already fetched,
+        for example by a bulk query, or `None` if the attachment has no
+        flags."""
         if not isinstance(attachment, Attachment):
             raise TypeError
         self.attachment = attachment
         self.env = env
         
-        self.__flags = {}
-        self.__updatedflags = []
-        
-        with env.db_query as db:
-            cursor = db.cursor()
-            cursor.execute("SELECT flag, value, updated_on, updated_by FROM attachmentflags WHERE "
-                           "type=%s AND id=%s AND filename=%s",
-                           (attachment.parent_realm, attachment.parent_id, attachment.filename))
-            for flag, value, updated_on, updated_by in cursor:
-                self.__flags[flag] = {"value": value,
-                                    "updated_on": updated_on,
-                                    "updated_by": updated_by}
+        self.__row = row # False until loaded
+        self.__updatedflags = None # {flag: author}
+        profile.count_object()
+
+    @classmethod
+    def select(cls, env, attachments):
+        """Load the flags for a list of attachments that belong to the same
+        parent resource, using a single query. Returns a dict that maps the
+        filename to its `AttachmentFlags`."""
+        if not attachments:
+            return {}
+        rows = _get_rows(env, attachments[0].parent_realm, attachments[0].parent_id)
+        return dict((attachment.filename, cls(env, attachment, rows.get(attachment.filename)))
+                    for attachment in attachments)
 
     def __contains__(self, item):
-        return item in self.__flags
+        return bool(self.__mask() & _bits.get(item, 0))
     
     def __getitem__(self, item):
-        return self.__flags[item]
+        if item not in self:
+            raise KeyError(item)
+        i = _flag_index[item]
+        return Flag(self.__row[2 * i + 1], self.__row[2 * i + 2])
     
     def __len__(self):
-        return len(self.__flags)
+        mask = self.__mask()
+        return sum(1 for flag, bit in flag_bits if mask & bit)
     
     def setflag(self, flag, value, author):
-        with self.env.db_transaction as db:
-            timestamp = time.time()
-            # It still needs to be added
-            if flag not in self.__flags:
-                db.cursor().execute("INSERT INTO attachmentflags VALUES "
-                               "(%s,%s,%s,%s,%s,%s,%s)", (self.attachment.parent_realm,
-                               self.attachment.parent_id, self.attachment.filename, flag, value,
-                               timestamp, author))
-                self.__updatedflags.append(flag)
-
-            self.__updatedflags.append(flag)
-            self.__flags[flag] = {"value": value,
-                                  "updated_on": timestamp,
-                                  "updated_by": author}
-
-    def finishupdate(self):
-        dbflags = self.__flags.keys()
-
-        for flag in self.__updatedflags:
-            if flag in dbflags:
-                dbflags.remove(flag)
+        """Mark `flag` to be set. Flags are boolean, so `value` only needs to
+        be true. Nothing is written until `finishupdate()` is called."""
+        if flag not in _bits:
+            raise ValueError("Unknown attachment flag: %s" % flag)
+        if value:
+            if self.__updatedflags is None:
+                self.__updatedflags = {}
+            self.__updatedflags[flag] = author
+
+    def finishupdate(self, when=None):
+        """Write the flags set with `setflag()` since the last update, and
+        remove all other flags, in a single statement. Newly set flags are
+        stamped with the datetime `when`, or with the current time. Returns
+        `True` when anything changed."""
+        realm = self.attachment.parent_realm
+        id = self.attachment.parent_id
+        filename = self.attachment.filename
+        timestamp = to_timestamp(when) if when else int(time.time())
+
+        flags = {}
+        for flag, author in (self.__updatedflags or {}).items():
+            if flag in self:
+                flags[flag] = self[flag]
+            else:
+                flags[flag] = Flag(timestamp, author)
+        self.__updatedflags = None
+        old_mask = self.__mask()
+        values = _pack_flags(flags)
+        if values[0] == old_mask:
+            return False
 
         with self.env.db_transaction as db:
-            if len(dbflags) > 0:
-                for flag in dbflags:
-                    cursor = db.cursor()
-                    cursor.execute("DELETE FROM attachmentflags WHERE type=%s AND "
-                                   "id=%s AND filename=%s AND flag=%s",
-                                   (self.attachment.parent_realm, self.attachment.parent_id,
-                                    self.attachment.filename, flag))
-                    del self.__flags[flag]
-        self.__updatedflags = []
+            cursor = profile.cursor(db)
+            if not flags:
+                cursor.execute("DELETE FROM attachmentflags WHERE type=%s AND id=%s "
+                               "AND filename=%s", (realm, id, filename))
+            elif old_mask:
+                cursor.execute("UPDATE attachmentflags SET %s, changes=changes+1 "
+                               "WHERE type=%%s AND id=%%s AND filename=%%s" %
+                               ','.join('%s=%%s' % column for column in
+                                        _flag_column_names + ['updated_on']),
+                               values + [timestamp, realm, id, filename])
+            else:
+                cursor.execute("INSERT INTO attachmentflags (type,id,filename,%s,updated_on,changes) "
+                               "VALUES (%s,1)" % (_flag_columns, ','.join(['%s'] * (len(values) + 4))),
+                               [realm, id, filename] + values + [timestamp])
+            update_summary(self.env, realm, id)
+
+        self.__row = tuple(values) if flags else None
+        invalidate_cache(self.env, realm, id)
+        return True
+
+    def __mask(self):
+        if self.__row is False:
+            attachment = self.attachment
+            if _get_cache(self.env):
+                self.__row = _get_rows(self.env, attachment.parent_realm,
+                                       attachment.parent_id).get(attachment.filename)
+            else:
+                with self.env.db_query as db:
+                    cursor = profile.cursor(db)
+                    cursor.execute("SELECT " + _flag_columns + " FROM attachmentflags WHERE "
+                                   "type=%s AND id=%s AND filename=%s",
+                                   (attachment.parent_realm, attachment.parent_id,
+                                    attachment.filename))
+                    self.__row = cursor.fetchone()
+        return self.__row[0] if self.__row else 0
+
+def _unpack_flags(row):
+    """Return the flags stored in a row of `_flag_columns`, as a dict
+    `{flag: Flag}`."""
+    flags = {}
+    for i, (flag, bit) in enumerate(flag_bits):
+        if row[0] & bit:
+            flags[flag] = Flag(row[2 * i + 1], row[2 * i + 2])
+    return flags
+
+def _pack_flags(flags):
+    """Return the values of `_flag_columns` for a dict of `Flag`s."""
+    values = [sum(bit for flag, bit in flag_bits if flag in flags)]
+    for flag, _ in flag_bits:
+        if flag in flags:
+            values += [flags[flag].updated_on, flags[flag].updated_by]
+        else:
+            values += [None, None]
+    return values
+
+def get_flags_modified(env, realm, ids):
+    """Return the last `updated_on` time of the flags of the resources with
+    the given `ids`, and a list of values that changes whenever their flags
+    change: the number of flagged attachments, the sum of their bitmasks and
+    the sum of their change counters. The flags themselves are not loaded."""
+    last = None
+    state = [0, 0, 0]
+    with env.db_query as db:
+        cursor = profile.cursor(db)
+        for chunk in _chunks(ids):
+            cursor.execute("SELECT MAX(updated_on), COUNT(*), SUM(flags), SUM(changes) "
+                           "FROM attachmentflags WHERE type=%%s AND id IN (%s)"
+                           % ','.join(['%s'] * len(chunk)), [realm] + chunk)
+            row = cursor.fetchone()
+            if row[0] is not None and row[0] > last:
+                last = row[0]
+            state = [total + (value or 0) for total, value in zip(state, row[1:])]
+    return last, state
+
+def select_flags(env, realm, ids):
+    """Return the flags of the attachments of the resources with the given
+    `ids`, as a dict `{id: {filename: {flag: {"updated_on": ...,
+    "updated_by": ...}}}}`."""
+    flags = dict((id, {}) for id in ids)
+    with env.db_query as db:
+        cursor = profile.cursor(db)
+        for chunk in _chunks(ids):
+            cursor.execute("SELECT id, filename, %s FROM attachmentflags "
+                           "WHERE type=%%s AND id IN (%s)"
+                           % (_flag_columns, ','.join(['%s'] * len(chunk))), [realm] + chunk)
+            for row in cursor:
+                flags[row[0]][row[1]] = dict((flag, record._asdict()) for flag, record
+                                             in _unpack_flags(row[2:]).items())
+    return flags
+
+def _chunks(ids, size=500):
+    ids = list(ids)
+    for i in xrange(0, len(ids), size):
+        yield ids[i:i + size]
+
+def invalidate_cache(env, realm, id):
+    """Drop the cached flags of the attachments of the resource."""
+    invalidate_caches(env, realm, [id])
+
+def invalidate_caches(env, realm, ids):
+    """Drop the cached flags of the attachments of the resources `ids`."""
+    cache = _get_cache(env)
+    if cache:
+        cache.invalidate_many(realm, ids)
+
+def _get_cache(env):
+    from attachmentflags.api import AttachmentFlagsCache
+    if env.is_component_enabled(AttachmentFlagsCache):
+        cache = AttachmentFlagsCache(env)
+        if cache.enabled:
+            return cache
+    return None
+
+def _get_rows(env, realm, id):
+    def load():
+        rows = {}
+        with env.db_query as db:
+            cursor = profile.cursor(db)
+            cursor.execute("SELECT filename, " + _flag_columns + " FROM attachmentflags "
+                           "WHERE type=%s AND id=%s", (realm, id))
+            for row in cursor:
+                rows[row[0]] = row[1:]
+        return rows
+    cache = _get_cache(env)
+    if cache:
+        return cache.get(realm, id, load)
+    return load()
+
+# Aggregates the flags per resource, counting the attachments that are a
+# patch and not obsolete, and the obsolete attachments.
+_summary_select = """
+    SELECT f.type, f.id,
+           SUM(CASE WHEN (f.flags & %(patch)d) <> 0 AND (f.flags & %(obsolete)d) = 0
+               THEN 1 ELSE 0 END),
+           SUM(CASE WHEN (f.flags & %(obsolete)d) <> 0 THEN 1 ELSE 0 END),
+           MAX(f.updated_on)
+    FROM attachmentflags f
+    INNER JOIN attachment a ON (a.type=f.type AND a.id=f.id
+                                AND a.filename=f.filename)
+    %%s
+    GROUP BY f.type, f.id""" % dict(flag_bits)
+
+def update_summary(env, realm, id):
+    """Recompute the row of the resource in the `attachmentflags_summary`
+    table. Call this in the transaction that changes the flags."""
+    update_summaries(env, realm, [id])
+
+def update_summaries(env, realm, ids):
+    """Recompute the rows of the resources with the given `ids` in the
+    `attachmentflags_summary` table. Call this in the transaction that
+    changes the flags."""
+    with env.db_transaction as db:
+        cursor = profile.cursor(db)
+        for chunk in _chunks(ids):
+            in_ids = ','.join(['%s'] * len(chunk))
+            cursor.execute("DELETE FROM attachmentflags_summary WHERE type=%%s "
+                           "AND id IN (%s)" % in_ids, [realm] + chunk)
+            cursor.execute("INSERT INTO attachmentflags_summary "
+                           "(type, id, patches, obsolete, updated_on) " +
+                           _summary_select % ("WHERE f.type=%%s AND f.id IN (%s)" % in_ids),
+                           [realm] + chunk)
+
+def rebuild_summary(env):
+    """Recompute the `attachmentflags_summary` table for all resources."""
+    with env.db_transaction as db:
+        cursor = profile.cursor(db)
+        cursor.execute("DELETE FROM attachmentflags_summary")
+        cursor.execute("INSERT INTO attachmentflags_summary "
+                       "(type, id, patches, obsolete, updated_on) " +
+                       _summary_select % "")
+
+def bulk_update_flag(env, realm, attachments, flag, value, author):
+    """Set `flag` on many attachments at once, or clear it when `value` is
+    false. `attachments` is a list of `(id, filename)` pairs, where a
+    filename of `None` selects all attachments of the resource. The flags
+    and the summary table are updated with a few statements in a single
+    transaction. Returns the ids of the resources whose flags changed."""
+    if flag not in _bits:
+        raise ValueError("Unknown attachment flag: %s" % flag)
+    bit = _bits[flag]
+    timestamp = int(time.time())
+    changed = set()
+    with env.db_transaction as db:
+        cursor = profile.cursor(db)
+        for group in _attachment_groups(attachments):
+            if value:
+                where, args = _attachment_condition(group, 'a.')
+                cursor.execute("SELECT DISTINCT a.id FROM attachment a "
+                               "LEFT OUTER JOIN attachmentflags f ON (f.type=a.type "
+                               "AND f.id=a.id AND f.filename=a.filename) "
+                               "WHERE a.type=%%s AND %s "
+                               "AND (f.flags IS NULL OR (f.flags & %d) = 0)" % (where, bit),
+                               [realm] + args)
+                ids = [row[0] for row in cursor]
+                if not ids:
+                    continue
+                changed.update(ids)
+                cursor.execute("INSERT INTO attachmentflags "
+                               "(type,id,filename,flags,%s_on,%s_by,updated_on,changes) "
+                               "SELECT a.type,a.id,a.filename,%d,%d,%%s,%d,1 FROM attachment a "
+                               "WHERE a.type=%%s AND %s AND NOT EXISTS (SELECT * "
+                               "FROM attachmentflags f WHERE f.type=a.type AND f.id=a.id "
+                               "AND f.filename=a.filename)"
+                               % (flag, flag, bit, timestamp, timestamp, where),
+                               [author, realm] + args)
+                where, args = _attachment_condition(group, '')
+                cursor.execute("UPDATE attachmentflags SET flags=flags+%d, %s_on=%d, "
+                               "%s_by=%%s, updated_on=%d, changes=changes+1 WHERE type=%%s AND %s "
+                               "AND (flags & %d) = 0"
+                               % (bit, flag, timestamp, flag, timestamp, where, bit),
+                               [author, realm] + args)
+            else:
+                where, args = _attachment_condition(group, '')
+                cursor.execute("SELECT DISTINCT id FROM attachmentflags "
+                               "WHERE type=%%s AND %s AND (flags & %d) <> 0" % (where, bit),
+                               [realm] + args)
+                ids = [row[0] for row in cursor]
+                if not ids:
+                    continue
+                changed.update(ids)
+                cursor.execute("UPDATE attachmentflags SET flags=flags-%d, %s_on=NULL, "
+                               "%s_by=NULL, updated_on=%d, changes=changes+1 WHERE type=%%s AND %s "
+                               "AND (flags & %d) <> 0"
+                               % (bit, flag, flag, timestamp, where, bit),
+                               [realm] + args)
+                cursor.execute("DELETE FROM attachmentflags WHERE type=%%s AND %s "
+                               "AND flags=0" % where, [realm] + args)
+        changed = sorted(changed)
+        update_summaries(env, realm, changed)
+
+    invalidate_caches(env, realm, changed)
+    return changed
+
+def _attachment_groups(attachments, size=500):
+    """Group `(id, filename)` pairs into lists of `(id, filenames)` that
+    take at most about `size` query parameters each. `filenames` is `None`
+    to select all attachments of the resource."""
+    filenames = {}
+    for id, filename in attachments:
+        if filename is None:
+            filenames[id] = None
+        elif filenames.get(id, ()) is not None:
+            filenames.setdefault(id, set()).add(filename)
+    group = []
+    count = 0
+    for id in sorted(filenames):
+        if filenames[id] is None:
+            chunks = [None]
+        else:
+            chunks = _chunks(sorted(filenames[id]), size - 1)
+        for chunk in chunks:
+            n = 1 + len(chunk or ())
+            if group and count + n > size:
+                yield group
+                group = []
+                count = 0
+            group.append((id, chunk))
+            count += n
+    if group:
+        yield group
+
+def _attachment_condition(group, prefix):
+    """Return the SQL condition and its arguments that select the
+    attachments of a group from `_attachment_groups()`."""
+    conditions = []
+    args = []
+    for id, filenames in group:
+        if filenames is None:
+            conditions.append("%sid=%%s" % prefix)
+            args.append(id)
+        else:
+            conditions.append("(%sid=%%s AND %sfilename IN (%s))" %
+                              (prefix, prefix, ','.join(['%s'] * len(filenames))))
+            args += [id] + filenames
+    return "(%s)" % " OR ".join(conditions), args
+
+def count_live_patches(env, realm, id):
+    """Return the number of attachments of the resource that are flagged as
+    a patch, but not as obsolete."""
+    with env.db_query as db:
+        cursor = profile.cursor(db)
+        cursor.execute("SELECT patches FROM attachmentflags_summary "
+                       "WHERE type=%s AND id=%s", (realm, id))
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+# Tickets whose patch field does not match the summary table
+_stale_patch_fields = """
+    FROM ticket t
+    LEFT OUTER JOIN ticket_custom c ON (c.ticket=t.id AND c.name='patch')
+    LEFT OUTER JOIN attachmentflags_summary s ON (s.type='ticket' AND s.id=%s)
+    WHERE COALESCE(c.value, '0')<>(CASE WHEN s.patches>0 THEN '1' ELSE '0' END)"""
+
+def select_stale_patch_fields(env, after=0, limit=1000):
+    """Return `(ticket id, live patches)` for the tickets with an id larger
+    than `after` whose patch field does not match the summary table, at
+    most `limit` of them and ordered by id."""
+    with env.db_query as db:
+        cursor = profile.cursor(db)
+        cursor.execute("SELECT t.id, COALESCE(s.patches, 0) " +
+                       _stale_patch_fields % db.cast('t.id', 'text') +
+                       " AND t.id>%%s ORDER BY t.id LIMIT %d" % limit, (after,))
+        return cursor.fetchall()
+
+def count_stale_patch_fields(env):
+    """Return the number of tickets whose patch field does not match the
+    summary table."""
+    with env.db_query as db:
+        cursor = profile.cursor(db)
+        cursor.execute("SELECT COUNT(*) " + _stale_patch_fields % db.cast('t.id', 'text'))
+        return cursor.fetchone()[0]
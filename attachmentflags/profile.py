@@ -0,0 +1,183 @@
+ #
+ # Copyright 2009-2017, Niels Sascha Reedijk <niels.reedijk@gmail.com>
+ # All rights reserved. Distributed under the terms of the MIT License.
+ #
+
+"""Hooks through which the plugin reports its work on a request to the
+`AttachmentFlagsProfiler`. They do nothing unless the current request is
+profiled, which costs a single thread-local lookup."""
+
+import threading
+from timeit import default_timer
+
+_local = threading.local()
+
+
+class RequestStats(object):
+    """What the plugin did while handling a request."""
+
+    __slots__ = ('profiler', 'path', 'ms', 'queries', 'objects', 'depth',
+                 'filters', 'ended', 'recorded')
+
+    def __init__(self, profiler, path):
+        self.profiler = profiler
+        self.path = path
+        self.ms = 0.0 # time spent in the timed sections
+        self.queries = 0
+        self.objects = 0
+        self.depth = 0 # number of open timed sections
+        self.filters = 0 # number of timed filters that are not done yet
+        self.ended = False # the request is handled, except for the filters
+        self.recorded = False # the totals are recorded
+
+def start(stats):
+    """Start profiling the request of the current thread with the given
+    `RequestStats`, or stop profiling when `stats` is `None`. Returns the
+    stats of the previous request."""
+    previous = getattr(_local, 'stats', None)
+    _local.stats = stats
+    return previous
+
+def current():
+    """Return the `RequestStats` of the request of the current thread, or
+    `None` when it is not profiled."""
+    return getattr(_local, 'stats', None)
+
+def end(stats):
+    """End the request of `stats`: stop profiling it, and record its totals
+    once the timed filters of its template are done."""
+    stats.ended = True
+    if getattr(_local, 'stats', None) is stats:
+        _local.stats = None
+    if not stats.filters:
+        stats.profiler.finish(stats)
+
+def end_filter(stats):
+    """Return a Genshi stream filter that ends the request of `stats` when
+    its template has been rendered."""
+    def filter(stream):
+        try:
+            for event in stream:
+                yield event
+        finally:
+            end(stats)
+    return filter
+
+def cursor(db):
+    """Return a cursor for `db` that counts the statements it executes."""
+    cursor = db.cursor()
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        return cursor
+    return _CountingCursor(cursor, stats)
+
+def count_object():
+    """Count the construction of an `AttachmentFlags` object."""
+    stats = getattr(_local, 'stats', None)
+    if stats is not None:
+        stats.objects += 1
+
+def timed(section):
+    """Return a context manager that measures the code in its block as
+    `section`."""
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        return _null_timer
+    return _Timer(stats, section)
+
+def timed_filter(section, filter):
+    """Wrap the Genshi stream `filter` so that the time spent in it while the
+    template is rendered is measured as `section`, leaving out the time spent
+    in the filters before and after it."""
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        return filter
+    stats.filters += 1
+    def wrapper(stream):
+        upstream = [0.0]
+        def source():
+            events = iter(stream)
+            while True:
+                start = default_timer()
+                try:
+                    event = events.next()
+                finally:
+                    upstream[0] += default_timer() - start
+                yield event
+        events = iter(filter(source()))
+        elapsed = 0.0
+        try:
+            while True:
+                start = default_timer()
+                try:
+                    event = events.next()
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += default_timer() - start
+                yield event
+        finally:
+            ms = (elapsed - upstream[0]) * 1000
+            stats.ms += ms
+            stats.profiler.add_sample(stats, section, ms, 0, 0)
+            stats.filters -= 1
+            if stats.ended and not stats.filters:
+                stats.profiler.finish(stats)
+    return wrapper
+
+
+class _Timer(object):
+
+    __slots__ = ('stats', 'section', 'start', 'queries', 'objects')
+
+    def __init__(self, stats, section):
+        self.stats = stats
+        self.section = section
+
+    def __enter__(self):
+        self.queries = self.stats.queries
+        self.objects = self.stats.objects
+        self.stats.depth += 1
+        self.start = default_timer()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stats = self.stats
+        ms = (default_timer() - self.start) * 1000
+        stats.depth -= 1
+        if not stats.depth:
+            stats.ms += ms
+        stats.profiler.add_sample(stats, self.section, ms,
+                                  stats.queries - self.queries,
+                                  stats.objects - self.objects)
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_null_timer = _NullTimer()
+
+
+class _CountingCursor(object):
+
+    def __init__(self, cursor, stats):
+        self.cursor = cursor
+        self.stats = stats
+
+    def execute(self, sql, args=None):
+        self.stats.queries += 1
+        return self.cursor.execute(sql, args)
+
+    def executemany(self, sql, args):
+        self.stats.queries += 1
+        return self.cursor.executemany(sql, args)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
@@ -0,0 +1,18 @@
+ #
+ # Copyright 2009-2017, Niels Sascha Reedijk <niels.reedijk@gmail.com>
+ # All rights reserved. Distributed under the terms of the MIT License.
+ #
+
+import unittest
+
+from attachmentflags.tests import api, web_ui
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(api.suite())
+    suite.addTest(web_ui.suite())
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
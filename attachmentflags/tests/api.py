@@ -0,0 +1,185 @@
+ #
+ # Copyright 2009-2017, Niels Sascha Reedijk <niels.reedijk@gmail.com>
+ # All rights reserved. Distributed under the terms of the MIT License.
+ #
+
+import unittest
+
+from genshi.input import XML
+from trac.db import Column, DatabaseManager, Table
+from trac.test import EnvironmentStub, Mock
+
+from attachmentflags import profile
+from attachmentflags.api import AttachmentFlagsCache, AttachmentFlagsProfiler, \
+                                AttachmentFlagsSystem
+
+# The attachmentflags table before revision 4, with one row per flag
+old_flags_table = Table('attachmentflags', key=('type','id','filename','flag')) [
+    Column('type'),
+    Column('id'),
+    Column('filename'),
+    Column('flag'),
+    Column('value'),
+    Column('updated_on', type="int"),
+    Column('updated_by'),
+]
+
+
+class UpgradeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'attachmentflags.*'])
+        self.system = AttachmentFlagsSystem(self.env)
+        self._upgrade()
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _upgrade(self):
+        with self.env.db_transaction as db:
+            if self.system.environment_needs_upgrade(db):
+                self.system.upgrade_environment(db)
+
+    def _create_old_table(self, rows):
+        db_manager = DatabaseManager(self.env)._get_connector()[0]
+        with self.env.db_transaction as db:
+            db("DROP TABLE attachmentflags")
+            for sql in db_manager.to_sql(old_flags_table):
+                db(sql)
+            db.executemany("INSERT INTO attachmentflags VALUES (%s,%s,%s,%s,%s,%s,%s)",
+                           rows)
+            db("UPDATE system SET value='3' WHERE name='attachmentflags'")
+
+    def test_convert_to_bitmask(self):
+        rows = [('ticket', str(id), 'fix%d.diff' % i, 'patch', 'on', id, 'joe')
+                for id in xrange(1, 12) for i in xrange(id % 3)]
+        rows += [('ticket', '2', 'fix1.diff', 'obsolete', 'on', 20, 'jane'),
+                 ('ticket', '2', 'fix1.diff', 'unknown', 'on', 30, 'jim'),
+                 ('wiki', 'Start', 'page.txt', 'obsolete', 'on', 40, 'jim')]
+        self._create_old_table(rows)
+        # Convert the flags of a few resources at a time
+        self.system.convert_batch_size = 4
+        self._upgrade()
+
+        flags = self.env.db_query("""
+            SELECT type,id,filename,flags,updated_on,changes,patch_on,patch_by,
+                   obsolete_on,obsolete_by
+            FROM attachmentflags""")
+        self.assertEqual(13, len(flags))
+        self.assertIn(('ticket', '1', 'fix0.diff', 1, 1, 1, 1, 'joe', None, None),
+                      flags)
+        self.assertIn(('ticket', '2', 'fix1.diff', 3, 20, 1, 2, 'joe', 20, 'jane'),
+                      flags)
+        self.assertIn(('wiki', 'Start', 'page.txt', 2, 40, 1, None, None, 40, 'jim'),
+                      flags)
+        with self.env.db_query as db:
+            self.assertNotIn('attachmentflags_old', db.get_table_names())
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'attachmentflags.*'])
+        self.cache = AttachmentFlagsCache(self.env)
+        self.loads = 0
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _get(self):
+        def loader():
+            self.loads += 1
+            return self.loads
+        return self.cache.get('ticket', '1', loader)
+
+    def _change_elsewhere(self):
+        # Another process changed flags and moved the generation forward
+        with self.env.db_transaction as db:
+            cursor = db.cursor()
+            cursor.execute("UPDATE system SET value=%s WHERE name=%s",
+                           (str(self.loads + 10), self.cache.generation_key))
+            if not cursor.rowcount:
+                cursor.execute("INSERT INTO system (name, value) VALUES (%s, %s)",
+                               (self.cache.generation_key, '10'))
+
+    def test_generation_checked_once_per_request(self):
+        self.cache.pre_process_request(Mock(), None)
+        self.assertEqual(1, self._get())
+        self._change_elsewhere()
+        self.assertEqual(1, self._get())
+        self.cache.pre_process_request(Mock(), None)
+        self.assertEqual(2, self._get())
+
+    def test_generation_checked_outside_of_requests(self):
+        self.assertEqual(1, self._get())
+        self.assertEqual(1, self._get())
+        self._change_elsewhere()
+        self.assertEqual(2, self._get())
+
+
+class ProfilerTestCase(unittest.TestCase):
+    """The totals of a request are recorded when the request ends, not when
+    the next one starts."""
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'attachmentflags.*'])
+        self.env.config.set('attachmentflags', 'profile', 'true')
+        self.profiler = AttachmentFlagsProfiler(self.env)
+
+    def tearDown(self):
+        profile.start(None)
+        self.env.reset_db()
+
+    def _request(self):
+        listeners = []
+        req = Mock(method='GET', path_info='/ticket/1',
+                   add_redirect_listener=listeners.append,
+                   redirect=lambda url: [l(req, url, False) for l in listeners])
+        self.profiler.pre_process_request(req, None)
+        with profile.timed('update_flags'):
+            pass
+        return req
+
+    def _requests(self):
+        return [s['count'] for s in self.profiler.stats() if s['section'] == 'request']
+
+    def test_rendered_template(self):
+        req = self._request()
+        self.profiler.post_process_request(req, 'ticket.html', {}, None)
+        self.assertEqual([], self._requests())
+        filter = profile.timed_filter('transform:ticket.html', lambda stream: stream)
+        stream = XML('<html><body>Ticket</body></html>') | filter
+        stream = self.profiler.filter_stream(req, 'GET', 'ticket.html', stream, {})
+        self.assertEqual([], self._requests())
+        stream.render('xhtml')
+        self.assertEqual([1], self._requests())
+        self.assertEqual(None, profile.current())
+
+    def test_redirect(self):
+        req = self._request()
+        req.redirect('/ticket/1')
+        self.assertEqual([1], self._requests())
+        self.assertEqual(None, profile.current())
+
+    def test_error(self):
+        req = self._request()
+        self.profiler.post_process_request(req, None, None, None)
+        self.assertEqual([1], self._requests())
+
+    def test_recorded_once(self):
+        req = self._request()
+        req.redirect('/ticket/1')
+        self.profiler.post_process_request(req, None, None, None)
+        self._request()
+        self.assertEqual([1], self._requests())
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(UpgradeTestCase))
+    suite.addTest(unittest.makeSuite(CacheTestCase))
+    suite.addTest(unittest.makeSuite(ProfilerTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
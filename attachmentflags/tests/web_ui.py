@@ -0,0 +1,275 @@
+ #
+ # Copyright 2009-2017, Niels Sascha Reedijk <niels.reedijk@gmail.com>
+ # All rights reserved. Distributed under the terms of the MIT License.
+ #
+
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urllib
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+
+from genshi.filters.transform import StreamBuffer, Transformer
+from genshi.input import XML
+from trac.attachment import Attachment
+from trac.test import EnvironmentStub, Mock, MockPerm
+from trac.ticket.batch import BatchModifyModule
+from trac.ticket.model import Ticket
+from trac.util.datefmt import datetime_now, to_timestamp, utc
+from trac.web.api import RequestDone, _RequestArgs
+from trac.web.href import Href
+
+from attachmentflags.api import AttachmentFlagsSystem
+from attachmentflags.model import AttachmentFlags
+from attachmentflags.web_ui import AttachmentFlagsModule
+
+
+def filter_with_transformers(env, stream, attachments):
+    """Filter ticket.html with the chain of Transformers that was used
+    before `AttachmentFlagsStreamFilter`, as a reference for its output."""
+    for attachment in attachments:
+        if "obsolete" in AttachmentFlags(env, attachment):
+            href = "/attachment/%s/%s/%s" % (attachment.parent_realm, attachment.parent_id,
+                                             urllib.quote(attachment.filename))
+            stream |= Transformer("//div[@id='attachments']/div[@class='attachments']/"
+                                  "dl[@class='attachments']/dt/a[contains(@href, '" +
+                                  href + "')]").wrap('s')
+    stream |= Transformer("//label[@for='field-patch']").wrap('strike')
+    buffer = StreamBuffer()
+    stream |= Transformer('//input[@id="field-patch" and (@checked)]')\
+        .copy(buffer).after(buffer).attr("disabled", "disabled")
+    stream |= Transformer('//input[@id="field-patch" and (@checked) '
+                          'and not (@disabled)]').attr("type", "hidden") \
+        .attr("checked", None).attr("id", None)
+    stream |= Transformer('//input[@id="field-patch" '
+                          'and not (@checked)]').attr("disabled", "disabled")
+    return stream
+
+def ticket_page(req, id, attachments, checked=True):
+    """Return the parts of a ticket page that are filtered."""
+    items = ''.join('<dt><a href="%s" title="View attachment">%s</a> '
+                    '<a href="%s" class="trac-rawlink">&#8203;</a></dt><dd>A patch</dd>'
+                    % (req.href.attachment('ticket', id, a.filename), a.filename,
+                       req.href('raw-attachment', 'ticket', id, a.filename))
+                    for a in attachments)
+    return XML('<html xmlns="http://www.w3.org/1999/xhtml"><body>'
+               '<div id="attachments"><h3>Attachments</h3><div class="attachments">'
+               '<dl class="attachments">%s</dl></div></div>'
+               '<form><label for="field-patch">Has a patch:</label>'
+               '<input type="checkbox" id="field-patch" name="field_patch" value="1"%s/>'
+               '</form></body></html>'
+               % (items, checked and ' checked="checked"' or ''))
+
+
+class AttachmentAddedTestCase(unittest.TestCase):
+    """The flags posted with an upload are stored with that attachment,
+    also when several uploads are handled at the same time.
+
+    The in-memory test database cannot be shared by threads, so the inserts
+    of the attachments are serialized by `db_lock`. These tests exercise the
+    per-thread salvage of the flags, not concurrent writes to the database.
+    """
+
+    flag_sets = [{}, {'patch': 'on'}, {'obsolete': 'on'},
+                 {'patch': 'on', 'obsolete': 'on'}]
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'attachmentflags.*'],
+                                   path=tempfile.mkdtemp())
+        self.env.config.set('ticket-custom', 'patch', 'checkbox')
+        self.env.config.set('ticket-custom', 'patch.value', '0')
+        system = AttachmentFlagsSystem(self.env)
+        with self.env.db_transaction as db:
+            system.environment_needs_upgrade(db)
+            system.upgrade_environment(db)
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'Ticket with patches'
+        ticket['reporter'] = 'joe'
+        ticket['patch'] = '0'
+        self.ticket_id = ticket.insert()
+        self.module = AttachmentFlagsModule(self.env)
+        # The in-memory database cannot be used by several threads at once
+        self.db_lock = threading.Lock()
+
+    def tearDown(self):
+        self.env.reset_db()
+        shutil.rmtree(self.env.path)
+
+    def _upload(self, filename, flags, delay=0, t=None):
+        """Handle the upload of `filename` with the given flags, like Trac
+        does: pre_process_request() salvages the flags, and the attachment
+        module inserts the attachment later in the same thread."""
+        args = {'action': 'new'}
+        for flag, value in flags.items():
+            args['flag_' + flag] = value
+        req = Mock(path_info='/attachment/ticket/%d/' % self.ticket_id,
+                   method='POST', args=args)
+        self.module.pre_process_request(req, None)
+        time.sleep(delay)
+        with self.db_lock:
+            attachment = Attachment(self.env, 'ticket', self.ticket_id)
+            attachment.author = 'joe'
+            attachment.insert(filename, StringIO(''), 0, t)
+        self.module.post_process_request(req, None, None, None)
+
+    def _flags(self, filename):
+        attachment = Attachment(self.env, 'ticket', self.ticket_id, filename)
+        flags = AttachmentFlags(self.env, attachment)
+        return set(flag for flag in self.module.known_flags if flag in flags)
+
+    def test_concurrent_uploads(self):
+        count = 200
+        def upload(i):
+            self._upload('file%d.diff' % i, self.flag_sets[i % len(self.flag_sets)],
+                         random.random() / 100)
+        ThreadPool(16).map(upload, range(count))
+
+        for i in range(count):
+            self.assertEqual(set(self.flag_sets[i % len(self.flag_sets)]),
+                             self._flags('file%d.diff' % i), 'file%d.diff' % i)
+        self.assertEqual('1', Ticket(self.env, self.ticket_id)['patch'])
+
+    def test_upload_without_flags(self):
+        self._upload('flagged.diff', {'patch': 'on'})
+        self._upload('plain.txt', {})
+        self.assertEqual(set(['patch']), self._flags('flagged.diff'))
+        self.assertEqual(set(), self._flags('plain.txt'))
+
+    def test_flags_have_upload_time(self):
+        t = datetime_now(utc) - timedelta(days=1)
+        self._upload('fix.diff', {'patch': 'on'}, t=t)
+        attachment = Attachment(self.env, 'ticket', self.ticket_id, 'fix.diff')
+        flags = AttachmentFlags(self.env, attachment)
+        self.assertEqual(to_timestamp(t), flags['patch'].updated_on)
+        self.assertEqual(to_timestamp(t), flags['patch']['updated_on'])
+        self.assertEqual('joe', flags['patch']['updated_by'])
+        self.assertTrue(flags['patch']['value'])
+
+    def test_flags_of_failed_upload_are_dropped(self):
+        # The attachment of the first request is never added
+        req = Mock(path_info='/attachment/ticket/%d/' % self.ticket_id,
+                   method='POST', args={'action': 'new', 'flag_obsolete': 'on'})
+        self.module.pre_process_request(req, None)
+        self.module.post_process_request(req, None, None, None)
+        self._upload('plain.txt', {})
+        self.assertEqual(set(), self._flags('plain.txt'))
+
+
+class BatchModifyTestCase(unittest.TestCase):
+    """The attachment flags of the batch modify form are updated when the
+    batch modify module saved the ticket changes, and only then."""
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'attachmentflags.*'],
+                                   path=tempfile.mkdtemp())
+        self.env.config.set('ticket-custom', 'due', 'time')
+        system = AttachmentFlagsSystem(self.env)
+        with self.env.db_transaction as db:
+            system.environment_needs_upgrade(db)
+            system.upgrade_environment(db)
+        ticket = Ticket(self.env)
+        ticket['summary'] = 'Ticket with patches'
+        ticket['reporter'] = 'joe'
+        self.ticket_id = ticket.insert()
+        self.attachment = Attachment(self.env, 'ticket', self.ticket_id)
+        self.attachment.author = 'joe'
+        self.attachment.insert('fix.diff', StringIO(''), 0)
+        self.module = AttachmentFlagsModule(self.env)
+
+    def tearDown(self):
+        self.env.reset_db()
+        shutil.rmtree(self.env.path)
+
+    def _batch_modify(self, **args):
+        def redirect(url):
+            raise RequestDone
+        args.update(batchmod_attachmentflags='obsolete:set', action='leave',
+                    selected_tickets=str(self.ticket_id))
+        req = Mock(path_info='/batchmodify', method='POST', args=_RequestArgs(args),
+                   authname='joe', perm=MockPerm(), href=Href('/trac'),
+                   chrome={'warnings': [], 'notices': []}, session={},
+                   tz=None, lc_time=None, redirect=redirect)
+        handler = self.module.pre_process_request(req, BatchModifyModule(self.env))
+        self.assertRaises(RequestDone, handler.process_request, req)
+        return req
+
+    def _obsolete(self):
+        return 'obsolete' in AttachmentFlags(self.env, self.attachment)
+
+    def test_flags_only(self):
+        self._batch_modify()
+        self.assertTrue(self._obsolete())
+
+    def test_with_ticket_changes(self):
+        self._batch_modify(batchmod_value_keywords='patch')
+        self.assertTrue(self._obsolete())
+        self.assertEqual('patch', Ticket(self.env, self.ticket_id)['keywords'])
+
+    def test_invalid_ticket_changes(self):
+        req = self._batch_modify(batchmod_value_due='not a date')
+        self.assertEqual(1, len(req.chrome['warnings']))
+        self.assertFalse(self._obsolete())
+
+    def test_failed_flag_update(self):
+        def fail(*args):
+            raise ValueError('failed')
+        self.module._bulk_update_flags = fail
+        self._batch_modify(batchmod_value_keywords='patch')
+        self.assertEqual('patch', Ticket(self.env, self.ticket_id)['keywords'])
+
+
+class TicketPageTestCase(unittest.TestCase):
+    """`AttachmentFlagsStreamFilter` renders ticket.html like the chain of
+    Transformers it replaced."""
+
+    def setUp(self):
+        self.env = EnvironmentStub(enable=['trac.*', 'attachmentflags.*'])
+        system = AttachmentFlagsSystem(self.env)
+        with self.env.db_transaction as db:
+            system.environment_needs_upgrade(db)
+            system.upgrade_environment(db)
+            db.executemany("INSERT INTO attachment (type,id,filename,size,time,"
+                           "description,author,ipnr) VALUES (%s,%s,%s,%s,%s,%s,%s,%s)",
+                           [('ticket', '1', filename, 0, 0, '', 'joe', '')
+                            for filename in ('fix.diff', 'fix 2.diff', 'log.txt')])
+        self.attachments = [Attachment(self.env, 'ticket', '1', filename)
+                            for filename in ('fix.diff', 'fix 2.diff', 'log.txt')]
+        for attachment in self.attachments[:2]:
+            flags = AttachmentFlags(self.env, attachment)
+            flags.setflag('patch', 'on', 'joe')
+            flags.setflag('obsolete', 'on', 'joe')
+            flags.finishupdate()
+        self.module = AttachmentFlagsModule(self.env)
+        self.req = Mock(href=Href('/trac'), perm=MockPerm(), authname='joe')
+
+    def tearDown(self):
+        self.env.reset_db()
+
+    def _assert_same_render(self, checked):
+        data = {'attachments': {'attachments': self.attachments}}
+        page = ticket_page(self.req, '1', self.attachments, checked)
+        expected = filter_with_transformers(self.env, page, self.attachments)
+        actual = self.module.filter_stream(self.req, 'GET', 'ticket.html', page, data)
+        self.assertEqual(expected.render('xhtml'), actual.render('xhtml'))
+
+    def test_checked_patch_field(self):
+        self._assert_same_render(True)
+
+    def test_unchecked_patch_field(self):
+        self._assert_same_render(False)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(AttachmentAddedTestCase))
+    suite.addTest(unittest.makeSuite(TicketPageTestCase))
+    suite.addTest(unittest.makeSuite(BatchModifyTestCase))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -5,18 +5,27 @@
 
 import datetime
 from genshi.builder import tag, Fragment
-from genshi.filters.transform import Transformer, StreamBuffer
+from genshi.core import Attrs, QName, START, END
+from genshi.filters.transform import Transformer
+from pkg_resources import resource_filename
 import re
-import urllib
+import threading
 
+from trac.admin.api import IAdminPanelProvider
 from trac.attachment import IAttachmentChangeListener, Attachment
 from trac.core import *
-from trac.ticket.model import Ticket
-from trac.web.api import IRequestFilter
-from trac.web.chrome import ITemplateStreamFilter
+from trac.resource import Resource, get_resource_url
+from trac.web.api import IRequestFilter, IRequestHandler, RequestDone
+from trac.web.chrome import ITemplateProvider, ITemplateStreamFilter
 from trac.util import get_reporter_id
-from trac.util.datefmt import pretty_timedelta, format_datetime, to_timestamp, utc
-from attachmentflags.model import AttachmentFlags
+from trac.util.datefmt import pretty_timedelta, format_datetime, http_date, utc
+from trac.util.presentation import to_json
+from trac.util.text import exception_to_unicode
+from attachmentflags import profile
+from attachmentflags.api import AttachmentFlagsCache, AttachmentFlagsProfiler, \
+                                PatchFieldUpdater
+from attachmentflags.model import AttachmentFlags, bulk_update_flag, get_flags_modified, \
+                                  invalidate_cache, select_flags, update_summary
 
 class AttachmentFlagsModule(Component):
     """Implements attachment flags for Trac's interface.
@@ -28,41 +37,51 @@ class AttachmentFlagsModule(Component):
     implements(IAttachmentChangeListener, IRequestFilter, ITemplateStreamFilter)
  
     known_flags = ["patch", "obsolete",]
+
+    # The operations of the bulk update forms
+    bulk_actions = [("patch:set", "Mark as patch"),
+                    ("patch:clear", "Unmark as patch"),
+                    ("obsolete:set", "Mark as obsolete"),
+                    ("obsolete:clear", "Unmark as obsolete"),]
     
-    salvaged_data = {}
+    def __init__(self):
+        # Flags posted with a new attachment, kept per thread from
+        # pre_process_request() until attachment_added() or the end of
+        # the request
+        self._salvaged = threading.local()
  
     # IAttachmentChangeListener methods
     def attachment_added(self, attachment):
         """Called when an attachment is added. Add the flags that we intercepted
         during a new command. No need to check permissions: if the user did have
         permission to create the attachment, he can create the flags."""
-        if len(self.salvaged_data) == 0:
+        salvaged_data = getattr(self._salvaged, 'data', None)
+        self._salvaged.data = None
+        if not salvaged_data:
             return
         
-        with self.env.db_transaction as db:
-            for flag, value in self.salvaged_data.items():
-                cursor = db.cursor()
-                cursor.execute("INSERT INTO attachmentflags VALUES "
-                               "(%s,%s,%s,%s,%s,%s,%s)", (attachment.parent_realm,
-                               attachment.parent_id, attachment.filename, flag, value,
-                               to_timestamp(attachment.date) , attachment.author))
-
-        # Update patch flag of the ticket if needed
-        if "patch" in self.salvaged_data and not "obsolete" in self.salvaged_data:
-            ticket = Ticket(self.env, int(attachment.parent_id))
-            ticket["patch"] = "1"
-            ticket.save_changes(attachment.author, None)
+        with profile.timed("attachment_added"):
+            flags = AttachmentFlags(self.env, attachment)
+            for flag, value in salvaged_data.items():
+                flags.setflag(flag, value, attachment.author)
+            flags.finishupdate(attachment.date)
+
+            # Update patch flag of the ticket if needed
+            self._update_patch_field(attachment.parent_id, attachment.author)
 
     def attachment_deleted(self, attachment):
         """Called when an attachment is deleted."""
         with self.env.db_transaction as db:
-            cursor = db.cursor()
+            cursor = profile.cursor(db)
             cursor.execute("DELETE FROM attachmentflags WHERE type=%s AND id=%s "
                            "AND filename=%s", (attachment.parent_realm, attachment.parent_id,
                                                attachment.filename))
+            update_summary(self.env, attachment.parent_realm, attachment.parent_id)
+        invalidate_cache(self.env, attachment.parent_realm, attachment.parent_id)
 
     # IRequestFilter methods
     def pre_process_request(self, req, handler):
+        self._salvaged.data = None
         if req.path_info.startswith('/attachment/') and 'ticket' in req.path_info:
             # Salvage flags for a new attachment. These will be stored
             # in attachment_added()
@@ -72,10 +91,12 @@ class AttachmentFlagsModule(Component):
                 # then the actual attachment will never be added.
                 
                 # Salvage all attachment flags.
+                salvaged_data = {}
                 for flag in self.known_flags:
                     data = req.args.get('flag_' + flag)
                     if data:
-                        self.salvaged_data[flag] = data
+                        salvaged_data[flag] = data
+                self._salvaged.data = salvaged_data
             # Update flags
             elif req.method == 'POST' and action == "update_flags":
                 match = re.match(r'/attachment/([^/]+)/([^/]+)/(.+)?$',req.path_info)
@@ -100,101 +121,152 @@ class AttachmentFlagsModule(Component):
                     if get_reporter_id(req) != attachment.author:
                         req.perm.require('TICKET_MODIFY')
                     
-                    for flag, value in flags.items():
-                        attachmentflags.setflag(flag, value, get_reporter_id(req))
-                    attachmentflags.finishupdate()
-                    
-                    # Update the patch field on the ticket
-                    with self.env.db_query as db:
-                        cursorattachments = db.cursor()
-                        cursorattachments.execute("SELECT filename FROM attachment WHERE type=%s "
-                                                  "AND id=%s", (attachment.parent_realm, attachment.parent_id))
-                        attachments = []
-                        for filename in cursorattachments: #I'm pretty sure we always end up with len>0
-                            attachments.append(filename[0])
-                    
-                        patchcount = 0
-                        for filename in attachments:
-                            has_patch = False
-                            cursorpatch = db.cursor()
-                            cursorpatch.execute("SELECT value FROM attachmentflags WHERE type='ticket' "
-                                                "AND flag='patch' AND id=%s AND filename=%s", (attachment.parent_id, filename))
-                            if cursorpatch.fetchone():
-                                # See whether the patch is obsoleted
-                                cursorobsolete = db.cursor()
-                                cursorobsolete.execute("SELECT filename FROM attachmentflags WHERE type='ticket' "
-                                                    "AND flag='obsolete' AND id=%s AND filename=%s", (attachment.parent_id,filename))
-                                if not cursorobsolete.fetchone():
-                                    has_patch = True
-                            if has_patch:
-                                patchcount += 1
-                                
-                        ticket = Ticket(self.env,int(attachment.parent_id))
-                        if patchcount > 0:
-                            ticket["patch"] = "1"
-                        else:
-                            ticket["patch"] = "0"
-                        ticket.save_changes(get_reporter_id(req), None)
+                    with profile.timed("update_flags"):
+                        for flag, value in flags.items():
+                            attachmentflags.setflag(flag, value, get_reporter_id(req))
+                        
+                        # Update the patch field on the ticket
+                        if attachmentflags.finishupdate():
+                            self._update_patch_field(attachment.parent_id, get_reporter_id(req))
                 
                 req.redirect(req.href.ticket(int(attachment.parent_id)))
+            # Update the flags of the selected attachments in the list
+            elif req.method == 'POST' and action == "update_flags_bulk":
+                match = re.match(r'/attachment/ticket/([^/]+)/?$', req.path_info)
+                if match:
+                    id = match.group(1)
+                    bulk = self._parse_bulk_action(req.args.get('bulk_action'))
+                    filenames = req.args.getlist('bulk_attachment')
+                    # This runs before Trac checks the form token, so check
+                    # it here. Without it Trac rejects the request later on.
+                    if req.args.get('__FORM_TOKEN') != req.form_token:
+                        return handler
+                    if bulk and filenames:
+                        # Same permissions as for a single attachment
+                        authors = set(attachment.author for attachment
+                                      in Attachment.select(self.env, 'ticket', id)
+                                      if attachment.filename in filenames)
+                        if authors - set([get_reporter_id(req)]):
+                            req.perm.require('TICKET_MODIFY')
+                        self._bulk_update_flags(req, [(id, filename) for filename in filenames],
+                                                *bulk)
+                    req.redirect(req.href.attachment('ticket', id) + '/')
+        elif req.path_info == '/batchmodify' and req.method == 'POST':
+            # Update the flags of all attachments of the selected tickets,
+            # once the batch modify module accepted the request
+            bulk = self._parse_bulk_action(req.args.get('batchmod_attachmentflags'))
+            if bulk and handler:
+                req.perm.require('TICKET_BATCH_MODIFY')
+                ids = [id for id in req.args.get('selected_tickets', '').split(',') if id]
+                return _BatchModifyHandler(handler, lambda: self._batch_update_flags(
+                    req, ids, *bulk))
 
         return handler
     
     def post_process_request(self, req, template, data, content_type):
+        # The flags were not used if the attachment was not added
+        self._salvaged.data = None
         return template, data, content_type        
  
 
     # ITemplateStreamFilter methods
     def filter_stream(self, req, method, filename, stream, data):
+        if filename in ("attachment.html", "ticket.html", "query.html"):
+            with profile.timed("filter_stream:" + filename):
+                for filter in self._get_stream_filters(req, filename, data):
+                    stream |= profile.timed_filter("transform:" + filename, filter)
+        return stream
+    
+    # Internal
+    def _get_stream_filters(self, req, filename, data):
         if filename == "attachment.html":
             if data["mode"] == "new" and data["attachment"].parent_realm == "ticket":
-                stream |= Transformer("//fieldset").after(self._generate_attachmentflags_fieldset(readonly=False))
+                yield Transformer("//fieldset").after(self._generate_attachmentflags_fieldset(readonly=False))
             elif data["mode"] == "list" and data["attachments"] and data["attachments"]["parent"].realm == "ticket":
-                stream = self._filter_obsolete_attachments_from_stream(stream, data["attachments"]["attachments"])
+                attachments = data["attachments"]["attachments"]
+                obsolete_hrefs = self._get_obsolete_hrefs(req, attachments)
+                bulk_form = None
+                # Everybody can update the flags of their own attachments,
+                # the others need TICKET_MODIFY
+                if 'TICKET_MODIFY' not in req.perm:
+                    author = get_reporter_id(req)
+                    attachments = [a for a in attachments if a.author == author]
+                if attachments:
+                    selectable = dict((get_resource_url(self.env, attachment.resource, req.href),
+                                       attachment.filename) for attachment in attachments)
+                    action = req.href.attachment('ticket', data["attachments"]["parent"].id) + '/'
+                    bulk_form = (action, self._generate_bulk_controls(), selectable)
+                if obsolete_hrefs or bulk_form:
+                    yield AttachmentFlagsStreamFilter(obsolete_hrefs, bulk_form=bulk_form)
             elif data["mode"] == "view" and data["attachment"].parent_realm == "ticket":
                 flags = AttachmentFlags(self.env, data["attachment"])
                 if 'TICKET_MODIFY' in req.perm or get_reporter_id(req) == data["attachment"].author:
-                    stream |= Transformer("//div[@id='preview']").after(self._generate_attachmentflags_fieldset(readonly=False, current_flags=flags, form=True))
+                    yield Transformer("//div[@id='preview']").after(self._generate_attachmentflags_fieldset(readonly=False, current_flags=flags, form=True))
                 else:
-                    stream |= Transformer("//div[@id='preview']").after(self._generate_attachmentflags_fieldset(current_flags=flags))
+                    yield Transformer("//div[@id='preview']").after(self._generate_attachmentflags_fieldset(current_flags=flags))
 
         if filename == "ticket.html":
+            obsolete_hrefs = set()
             if "attachments" in data:
-                stream = self._filter_obsolete_attachments_from_stream(stream, data["attachments"]["attachments"])
-            stream |= Transformer("//label[@for='field-patch']").wrap('strike')
-
-            buffer = StreamBuffer()
-            #stream |= Transformer("//input[@id='field-patch']").attr('disabled','disabled')
-            # Copy a checked box to buffer then disable original
-            stream |= Transformer('//input[@id="field-patch" and (@checked)]')\
-                .copy(buffer).after(buffer).attr("disabled","disabled")
-            # Change new element to hidden field instead of checkbox and
-            # remove check
-            stream |= Transformer('//input[@id="field-patch" and (@checked) \
-                and not (@disabled)]').attr("type","hidden") \
-                .attr("checked", None).attr("id", None)
-            
-            # Disable any unchecked fields
-            # NOTE: if the box was checked and copied, the id is removed so the
-            # hidden field will not be disabled here.
-            stream |= Transformer('//input[@id="field-patch" \
-                and not (@checked)]').attr("disabled", "disabled")
+                obsolete_hrefs = self._get_obsolete_hrefs(req, data["attachments"]["attachments"])
+            yield AttachmentFlagsStreamFilter(obsolete_hrefs, patch_field=True)
         
         
         if filename == "query.html":
             # Filter the patch field from the Trac 1.0 batch modify utility
-            stream |= Transformer("//select[@id='add_batchmod_field']/option[@value='patch']").remove()
-        return stream
-    
-    # Internal
+            yield Transformer("//select[@id='add_batchmod_field']/option[@value='patch']").remove()
+            # Add the attachment flags to it instead
+            options = [tag.option(label, value=value) for value, label in self.bulk_actions]
+            yield Transformer("//tr[@id='add_batchmod_field_row']").before(
+                tag.tr(tag.th(tag.label("All attachments:", for_="batchmod_attachmentflags"),
+                              colspan="2"),
+                       tag.td(tag.select(tag.option(), options, id="batchmod_attachmentflags",
+                                         name="batchmod_attachmentflags")),
+                       id="batchmod_attachmentflags_row"))
+
+    def _parse_bulk_action(self, value):
+        """Return `(flag, value)` for one of the `bulk_actions`, or `None`."""
+        if value and ':' in value:
+            flag, operation = value.split(':', 1)
+            if flag in self.known_flags and operation in ("set", "clear"):
+                return flag, operation == "set"
+        return None
+
+    def _bulk_update_flags(self, req, attachments, flag, value):
+        author = get_reporter_id(req)
+        with profile.timed("update_flags_bulk"):
+            for id in bulk_update_flag(self.env, "ticket", attachments, flag, value, author):
+                self._update_patch_field(id, author)
+
+    def _batch_update_flags(self, req, ids, flag, value):
+        # The ticket changes are saved at this point, so do not turn the
+        # request into an error
+        try:
+            self._bulk_update_flags(req, [(id, None) for id in ids], flag, value)
+        except Exception, e:
+            self.log.error("Failed to update the attachment flags of tickets %s: %s",
+                           ', '.join(ids), exception_to_unicode(e, traceback=True))
+
+    def _generate_bulk_controls(self):
+        return tag.div(tag.input(type="hidden", name="action", value="update_flags_bulk"),
+                       tag.select([tag.option(label, value=value)
+                                   for value, label in self.bulk_actions],
+                                  name="bulk_action"), " ",
+                       tag.input(type="submit", value="Update selected attachments"),
+                       class_="buttons")
+
+    def _update_patch_field(self, ticket_id, author):
+        with profile.timed("update_patch_field"):
+            PatchFieldUpdater(self.env).update(ticket_id, author)
+
     def _generate_attachmentflags_fieldset(self, readonly=True, current_flags=None, form=False):
         fields = Fragment()
         for flag in self.known_flags:
             flagid = 'flag_' + flag
             if current_flags and flag in current_flags:
-                date = datetime.datetime.fromtimestamp(current_flags[flag]["updated_on"],utc)
+                date = datetime.datetime.fromtimestamp(current_flags[flag].updated_on,utc)
                 text = tag.span(tag.strong(flag), " set by ", 
-                                tag.em(current_flags[flag]["updated_by"]), ", ", tag.span(pretty_timedelta(date),
+                                tag.em(current_flags[flag].updated_by), ", ", tag.span(pretty_timedelta(date),
                                                   title=format_datetime(date)), " ago")
                 if readonly == True:
                     fields += tag.input(text, \
@@ -221,10 +293,197 @@ class AttachmentFlagsModule(Component):
                             method="POST")
         return tag.fieldset(tag.legend("Attachment Flags") + fields)
 
-    def _filter_obsolete_attachments_from_stream(self, stream, attachments):
-        for attachment in attachments:
-            flags = AttachmentFlags(self.env, attachment)
-            if "obsolete" in flags:
-                href = "/attachment/%s/%s/%s" % (attachment.parent_realm, attachment.parent_id, urllib.quote(attachment.filename))
-                stream |= Transformer("//div[@id='attachments']/div[@class='attachments']/dl[@class='attachments']/dt/a[contains(@href, '" + href + "')]").wrap('s')
-        return stream                
+    def _get_obsolete_hrefs(self, req, attachments):
+        flagsets = AttachmentFlags.select(self.env, attachments)
+        return set(get_resource_url(self.env, attachment.resource, req.href)
+                   for attachment in attachments
+                   if "obsolete" in flagsets[attachment.filename])
+
+
+class _BatchModifyHandler(object):
+    """Wraps the batch modify handler to call `update` after it saved the
+    ticket changes.
+
+    The handler redirects once the changes are committed. It also redirects
+    without saving anything when the posted values are invalid, so these are
+    checked the same way it does first. Any other failure to save raises an
+    error instead of redirecting."""
+
+    def __init__(self, handler, update):
+        self.handler = handler
+        self.update = update
+
+    def __getattr__(self, name):
+        return getattr(self.handler, name)
+
+    def process_request(self, req):
+        get_new_values = getattr(self.handler, '_get_new_ticket_values', None)
+        if get_new_values is not None:
+            try:
+                get_new_values(req)
+            except TracError:
+                return self.handler.process_request(req)
+        try:
+            return self.handler.process_request(req)
+        except RequestDone:
+            self.update()
+            raise
+
+
+class AttachmentFlagsJSONModule(Component):
+    """Serves the attachment flags of resources as JSON.
+     * /attachmentflags/<realm>/<id>: the flags of the attachments of one
+       resource
+     * /attachmentflags/<realm>?id=<id>&id=<id>...: the flags of the
+       attachments of several resources
+    Responses carry an ETag and a Last-Modified header, and conditional
+    requests are answered with 304 Not Modified without loading the flags.
+    """
+
+    implements(IRequestHandler)
+
+    # IRequestHandler methods
+    def match_request(self, req):
+        match = re.match(r'/attachmentflags/([^/]+)(?:/(.+))?$', req.path_info)
+        if match:
+            req.args['realm'], id = match.groups()
+            if id:
+                req.args['resource_id'] = id
+            return True
+        return False
+
+    def process_request(self, req):
+        realm = req.args['realm']
+        single = 'resource_id' in req.args
+        if single:
+            ids = [req.args['resource_id']]
+        else:
+            ids = req.args.getlist('id')
+        for id in ids:
+            req.perm(Resource(realm, id).child('attachment')).require('ATTACHMENT_VIEW')
+
+        updated_on, state = get_flags_modified(self.env, realm, ids)
+        last_modified = datetime.datetime.fromtimestamp(updated_on or 0, utc)
+        req.check_modified(last_modified, state + ids)
+        req.send_header('Last-Modified', http_date(last_modified))
+
+        flags = select_flags(self.env, realm, ids)
+        if single:
+            data = {'realm': realm, 'id': ids[0], 'attachments': flags[ids[0]]}
+        else:
+            data = {'realm': realm, 'resources': flags}
+        req.send(to_json(data), 'application/json')
+
+
+class AttachmentFlagsAdminPanel(Component):
+    """Shows the measurements of the `AttachmentFlagsProfiler` and the
+    statistics of the attachment flags cache to administrators."""
+
+    implements(IAdminPanelProvider, ITemplateProvider)
+
+    # IAdminPanelProvider methods
+    def get_admin_panels(self, req):
+        if 'TRAC_ADMIN' in req.perm:
+            yield ('attachmentflags', 'Attachment Flags', 'stats', 'Statistics')
+
+    def render_admin_panel(self, req, category, panel, path_info):
+        req.perm.require('TRAC_ADMIN')
+        profiler = AttachmentFlagsProfiler(self.env)
+        if req.method == 'POST' and 'reset' in req.args:
+            profiler.reset()
+            req.redirect(req.href.admin(category, panel))
+        cache = AttachmentFlagsCache(self.env)
+        data = {
+            'profile': profiler.enabled,
+            'sections': profiler.stats(),
+            'cache': cache.stats() if cache.enabled else None,
+        }
+        return 'attachmentflags_admin_stats.html', data
+
+    # ITemplateProvider methods
+    def get_htdocs_dirs(self):
+        return []
+
+    def get_templates_dirs(self):
+        return [resource_filename(__name__, 'templates')]
+
+
+class AttachmentFlagsStreamFilter(object):
+    """Genshi stream filter that applies all changes to ticket.html and to
+    the attachment list in a single pass over the stream:
+     * strike through the links to obsolete attachments
+     * strike through the label of the patch field
+     * disable the patch checkbox, and submit a checked value through a
+       hidden copy of the field
+     * with `bulk_form`, a tuple `(action, controls, selectable)`: wrap the
+       attachment list in a form that posts to `action` and ends with
+       `controls`, and add a checkbox for the attachments in `selectable`,
+       a dict `{href: filename}`
+    """
+
+    def __init__(self, obsolete_hrefs, patch_field=False, bulk_form=None):
+        self.obsolete_hrefs = obsolete_hrefs
+        self.patch_field = patch_field
+        self.bulk_form = bulk_form
+
+    def __call__(self, stream):
+        path = [] # [(localname, attrs), ...] of the open elements
+        after = {} # {depth: [event, ...]} to emit after closing that element
+        selectable = self.bulk_form[2] if self.bulk_form else {}
+        for kind, data, pos in stream:
+            if kind is START:
+                tag, attrs = data
+                name = tag.localname
+                depth = len(path)
+                if name == 'dl' and self.bulk_form and \
+                        attrs.get('class') == 'attachments' and \
+                        self._in_attachments_div(path):
+                    action, controls = self.bulk_form[:2]
+                    form = QName('form')
+                    yield START, (form, Attrs([(QName('method'), 'post'),
+                                               (QName('action'), action)])), pos
+                    after[depth] = list(controls.generate()) + [(END, form, pos)]
+                elif name == 'a' and (self.obsolete_hrefs or selectable) and \
+                        self._in_attachment_list(path):
+                    href = attrs.get('href')
+                    if href in selectable:
+                        checkbox = QName('input')
+                        yield START, (checkbox, Attrs([(QName('type'), 'checkbox'),
+                                                       (QName('name'), 'bulk_attachment'),
+                                                       (QName('value'), selectable[href])])), pos
+                        yield END, checkbox, pos
+                    if href in self.obsolete_hrefs:
+                        yield START, (QName('s'), Attrs()), pos
+                        after[depth] = [(END, QName('s'), pos)]
+                elif self.patch_field and name == 'label' and \
+                        attrs.get('for') == 'field-patch':
+                    yield START, (QName('strike'), Attrs()), pos
+                    after[depth] = [(END, QName('strike'), pos)]
+                elif self.patch_field and name == 'input' and \
+                        attrs.get('id') == 'field-patch':
+                    if 'checked' in attrs:
+                        # A disabled field is not submitted, so add a hidden
+                        # copy that carries the value
+                        hidden = (attrs | [(QName('type'), 'hidden')]) - 'checked' - 'id'
+                        after[depth] = [(START, (tag, hidden), pos), (END, tag, pos)]
+                    data = tag, attrs | [(QName('disabled'), 'disabled')]
+                path.append((name, attrs))
+            elif kind is END and path:
+                path.pop()
+                yield kind, data, pos
+                for event in after.pop(len(path), ()):
+                    yield event
+                continue
+            yield kind, data, pos
+
+    def _in_attachments_div(self, path):
+        # div[@id='attachments']/div[@class='attachments']
+        return len(path) >= 2 and \
+               path[-1][0] == 'div' and path[-1][1].get('class') == 'attachments' and \
+               path[-2][0] == 'div' and path[-2][1].get('id') == 'attachments'
+
+    def _in_attachment_list(self, path):
+        # div[@id='attachments']/div[@class='attachments']/dl[@class='attachments']/dt
+        return len(path) >= 4 and path[-1][0] == 'dt' and \
+               path[-2][0] == 'dl' and path[-2][1].get('class') == 'attachments' and \
+               self._in_attachments_div(path[:-2])
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+ #
+ # Copyright 2009-2017, Niels Sascha Reedijk <niels.reedijk@gmail.com>
+ # All rights reserved. Distributed under the terms of the MIT License.
+ #
+
+"""Benchmarks for the hot paths of the AttachmentFlags plugin.
+
+The benchmarks run against a Trac EnvironmentStub on an in-memory SQLite
+database, filled with N tickets of M attachments each. Every attachment is
+flagged as a patch, and every other one as obsolete. The results are printed
+as JSON, with the times in milliseconds. The upgrade is compared with the
+table copy of the upgrades before revision 2, which needs a Unix system to
+measure the memory in a child process:
+
+  python benchmarks/bench_attachmentflags.py --tickets 100 --attachments 10
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from genshi.input import XML
+from trac.attachment import Attachment
+from trac.db import Column, DatabaseManager, Index, Table
+from trac.resource import Resource
+from trac.test import EnvironmentStub, Mock, MockPerm
+from trac.ticket.model import Ticket
+from trac.web.href import Href
+
+from attachmentflags.api import AttachmentFlagsSystem
+from attachmentflags.model import AttachmentFlags
+from attachmentflags.tests.web_ui import filter_with_transformers
+from attachmentflags.web_ui import AttachmentFlagsModule
+
+# The attachmentflags table before revision 4, with one row per flag
+old_flags_table = Table('attachmentflags', key=('type','id','filename','flag')) [
+    Column('type'),
+    Column('id'),
+    Column('filename'),
+    Column('flag'),
+    Column('value'),
+    Column('updated_on', type="int"),
+    Column('updated_by'),
+    Index(['flag', 'value']),
+    Index(['updated_on']),
+]
+
+
+def create_env(cache=True):
+    env = EnvironmentStub(enable=['trac.*', 'attachmentflags.*'])
+    env.config.set('ticket-custom', 'patch', 'checkbox')
+    env.config.set('ticket-custom', 'patch.value', '0')
+    if not cache:
+        env.config.set('attachmentflags', 'cache_size', '0')
+    return env
+
+def upgrade(env):
+    system = AttachmentFlagsSystem(env)
+    with env.db_transaction as db:
+        if system.environment_needs_upgrade(db):
+            system.upgrade_environment(db)
+
+def fill(env, tickets, attachments):
+    """Create the tickets and attachments, and flag the attachments. Returns
+    `{ticket id: [Attachment, ...]}`."""
+    now = int(time.time())
+    data = {}
+    for i in xrange(tickets):
+        ticket = Ticket(env)
+        ticket['summary'] = 'Ticket %d' % i
+        ticket['reporter'] = 'reporter'
+        ticket['patch'] = '0'
+        id = str(ticket.insert())
+        with env.db_transaction as db:
+            db.executemany("INSERT INTO attachment (type,id,filename,size,time,"
+                           "description,author,ipnr) VALUES (%s,%s,%s,%s,%s,%s,%s,%s)",
+                           [('ticket', id, 'patch%d.diff' % j, 1024, now, '',
+                             'reporter', '127.0.0.1') for j in xrange(attachments)])
+        data[id] = [Attachment(env, 'ticket', id, 'patch%d.diff' % j)
+                    for j in xrange(attachments)]
+        for j, attachment in enumerate(data[id]):
+            flags = AttachmentFlags(env, attachment)
+            flags.setflag('patch', 'on', 'reporter')
+            if j % 2 == 0:
+                flags.setflag('obsolete', 'on', 'reporter')
+            flags.finishupdate()
+    return data
+
+def make_req(env, path_info='/', method='GET', args=None):
+    return Mock(path_info=path_info, method=method, args=args or {},
+                authname='reporter', perm=MockPerm(), href=Href('/trac'),
+                abs_href=Href('http://example.org/trac'), redirect=lambda url: None)
+
+def ticket_page(env, req, id, attachments):
+    """Return a ticket page with the parts that the plugin filters."""
+    items = ''.join('<dt><a href="%s" title="View attachment">%s</a> '
+                    '<a href="%s" class="trac-rawlink">&#8203;</a> (1 KB)</dt>'
+                    '<dd>A patch</dd>'
+                    % (req.href.attachment('ticket', id, a.filename), a.filename,
+                       req.href('raw-attachment', 'ticket', id, a.filename))
+                    for a in attachments)
+    changes = ''.join('<div class="change"><h3>Comment %d</h3>'
+                      '<p>Lorem ipsum <em>dolor</em> sit amet.</p></div>' % i
+                      for i in xrange(50))
+    return XML('<html xmlns="http://www.w3.org/1999/xhtml"><body>'
+               '<div id="ticket">Ticket %s</div>'
+               '<div id="attachments"><h3>Attachments</h3><div class="attachments">'
+               '<dl class="attachments">%s</dl></div></div>'
+               '<div id="changelog">%s</div>'
+               '<form><table><tr><th><label for="field-patch">Has a patch:</label></th>'
+               '<td><input type="checkbox" id="field-patch" name="field_patch" '
+               'value="1" checked="checked"/></td></tr></table></form>'
+               '</body></html>' % (id, items, changes))
+
+def measure(func, repeat, setup=None):
+    """Call `func` `repeat` times with the number of the call, or with the
+    value that `setup` returns for it, and return statistics of the
+    durations in milliseconds. The time spent in `setup` is not counted."""
+    times = []
+    for i in xrange(repeat):
+        arg = setup(i) if setup else i
+        start = timeit.default_timer()
+        func(arg)
+        times.append((timeit.default_timer() - start) * 1000)
+    times.sort()
+    return {
+        'repeat': repeat,
+        'min': times[0],
+        'median': times[len(times) // 2],
+        'mean': sum(times) / len(times),
+        'max': times[-1],
+    }
+
+
+def bench_hot_paths(args):
+    env = create_env(cache=not args.no_cache)
+    upgrade(env)
+    data = fill(env, args.tickets, args.attachments)
+    ids = sorted(data, key=int)
+    module = AttachmentFlagsModule(env)
+    results = {}
+
+    def attachments(i):
+        return data[ids[i % len(ids)]]
+
+    def construct(i):
+        for flags in [AttachmentFlags(env, a) for a in attachments(i)]:
+            'obsolete' in flags
+    results['construct'] = measure(construct, args.repeat)
+
+    def select(i):
+        for flags in AttachmentFlags.select(env, attachments(i)).values():
+            'obsolete' in flags
+    results['select'] = measure(select, args.repeat)
+
+    def finishupdate(i):
+        # Alternately set and clear the flags of the first attachment
+        flags = AttachmentFlags(env, attachments(i // 2)[0])
+        if i % 2:
+            flags.setflag('patch', 'on', 'reporter')
+        flags.finishupdate()
+    results['setflag_finishupdate'] = measure(finishupdate, args.repeat)
+
+    def update_flags(i):
+        attachment = attachments(i // 2)[-1]
+        args = {'action': 'update_flags'}
+        if i % 2:
+            args['flag_patch'] = 'on'
+        req = make_req(env, '/attachment/ticket/%s/%s' % (attachment.parent_id,
+                                                          attachment.filename),
+                       'POST', args)
+        module.pre_process_request(req, None)
+    results['update_flags_request'] = measure(update_flags, args.repeat)
+
+    req = make_req(env)
+    pages = dict((id, ticket_page(env, req, id, data[id])) for id in ids)
+
+    def filter_ticket(i):
+        id = ids[i % len(ids)]
+        module.filter_stream(req, 'GET', 'ticket.html', pages[id],
+                             {'attachments': {'attachments': data[id]}}).render('xhtml')
+    results['filter_stream_ticket'] = measure(filter_ticket, args.repeat)
+
+    def filter_ticket_baseline(i):
+        # The chain of Transformers that AttachmentFlagsStreamFilter replaced
+        id = ids[i % len(ids)]
+        filter_with_transformers(env, pages[id], data[id]).render('xhtml')
+    results['filter_stream_ticket_baseline'] = measure(filter_ticket_baseline, args.repeat)
+
+    def filter_attachment_list(i):
+        id = ids[i % len(ids)]
+        module.filter_stream(req, 'GET', 'attachment.html', pages[id],
+                             {'mode': 'list',
+                              'attachments': {'parent': Resource('ticket', id),
+                                              'attachments': data[id]}}).render('xhtml')
+    results['filter_stream_attachment_list'] = measure(filter_attachment_list, args.repeat)
+
+    def render_only(i):
+        pages[ids[i % len(ids)]].render('xhtml')
+    results['render_baseline'] = measure(render_only, args.repeat)
+
+    return results
+
+def copy_table_baseline(env):
+    """The table copy of upgrade_environment() before revision 2: read the
+    whole table into memory, recreate it and insert the rows one by one."""
+    db_manager = DatabaseManager(env)._get_connector()[0]
+    with env.db_transaction as db:
+        cursor = db.cursor()
+        cursor.execute("SELECT * FROM attachmentflags")
+        columns = [d[0] for d in cursor.description]
+        rows = cursor.fetchall()
+        cursor.execute("DROP TABLE attachmentflags")
+        for sql in db_manager.to_sql(old_flags_table):
+            cursor.execute(sql)
+        sql = "INSERT INTO attachmentflags (%s) VALUES (%s)" % \
+              (','.join(columns), ','.join(['%s'] * len(columns)))
+        for row in rows:
+            cursor.execute(sql, row)
+
+def max_rss_growth(func, setup):
+    """Run `setup` and `func` in a child process, and return by how many KB
+    the peak resident set size of that process grew during `func`."""
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        arg = setup(0)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        func(arg)
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write, str(after - before))
+        os._exit(0)
+    os.close(write)
+    growth = os.read(read, 64)
+    os.close(read)
+    os.waitpid(pid, 0)
+    return int(growth)
+
+def bench_upgrade(args):
+    """Time the upgrade of a table in the layout of revision 3, with a patch
+    and an obsolete flag for every attachment, and compare it with the table
+    copy that upgrades did before revision 2."""
+    rows = args.tickets * args.attachments
+    def setup(i):
+        env = create_env()
+        upgrade(env)
+        db_manager = DatabaseManager(env)._get_connector()[0]
+        now = int(time.time())
+        with env.db_transaction as db:
+            db("DROP TABLE attachmentflags")
+            for sql in db_manager.to_sql(old_flags_table):
+                db(sql)
+            # Insert in chunks, to keep the peak memory of the setup low
+            for start in xrange(0, rows, 1000):
+                db.executemany("INSERT INTO attachmentflags VALUES (%s,%s,%s,%s,%s,%s,%s)",
+                               [('ticket', str(j // args.attachments), 'patch%d.diff' % j,
+                                 flag, 'on', now, 'reporter')
+                                for j in xrange(start, min(start + 1000, rows))
+                                for flag in ('patch', 'obsolete')])
+            db("UPDATE system SET value='3' WHERE name='attachmentflags'")
+        return env
+    results = {}
+    for name, func in (('upgrade_environment', upgrade),
+                       ('upgrade_baseline_copy', copy_table_baseline)):
+        result = results[name] = measure(func, args.upgrade_repeat, setup)
+        result['rows'] = rows * 2
+        result['rows_per_second'] = rows * 2 / (result['median'] / 1000)
+        result['max_rss_growth_kb'] = max_rss_growth(func, setup)
+    return results
+
+def versions():
+    import genshi, sqlite3, trac
+    return {
+        'python': platform.python_version(),
+        'trac': trac.__version__,
+        'genshi': getattr(genshi, '__version__', None),
+        'sqlite': sqlite3.sqlite_version,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tickets', type=int, default=100,
+                        help='number of tickets (default: %(default)s)')
+    parser.add_argument('--attachments', type=int, default=10,
+                        help='attachments per ticket (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='runs of each hot path (default: %(default)s)')
+    parser.add_argument('--upgrade-repeat', type=int, default=3,
+                        help='runs of the upgrade (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='disable the attachment flags cache')
+    parser.add_argument('--upgrade-only', action='store_true',
+                        help='only benchmark the upgrade')
+    parser.add_argument('--output', help='write the results to this file')
+    args = parser.parse_args()
+
+    results = {} if args.upgrade_only else bench_hot_paths(args)
+    results.update(bench_upgrade(args))
+    report = {
+        'time': int(time.time()),
+        'versions': versions(),
+        'parameters': {'tickets': args.tickets, 'attachments': args.attachments,
+                       'repeat': args.repeat, 'upgrade_repeat': args.upgrade_repeat,
+                       'cache': not args.no_cache},
+        'results': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
@@ -10,8 +10,8 @@ from setuptools import setup
 setup(
     name = 'TracAttachmentFlags',
     version = '0.2.0',
-    packages = ['attachmentflags'],
-#    package_data = { 'attachmentflags': ['htdocs/*.js'] },
+    packages = ['attachmentflags', 'attachmentflags.tests'],
+    package_data = { 'attachmentflags': ['templates/*.html'] },
 
     author = 'Niels Sascha Reedijk',
     author_email = 'niels.reedijk@gmail.com',
@@ -36,6 +36,7 @@ setup(
     ],
     
     install_requires = ['Trac>=1.2', 'Genshi>=0.6'],
+    test_suite = 'attachmentflags.tests.suite',
 
     entry_points = {
         'trac.plugins': [